@@ -119,11 +119,9 @@ class PLA_INO_Heater:
             )
         with self.lock:
             self.target_temp = degrees
-            logging.info(
-                f"J: set_temp -> get the serial object from the printer {self.sensor.write_queue}"
-            )
-            s = "s " + str(int(self.target_temp)) + "\0"
-            self.sensor.write_queue.put(s)
+            s = b"s %d\0" % (int(self.target_temp),)
+            logging.debug("J: set_temp queued for INO: %r", s)
+            self.sensor.write_queue.append(s)
 
     def get_temp(self, eventtime):
         with self.lock:
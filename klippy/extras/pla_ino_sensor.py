@@ -4,16 +4,24 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging
+import os
 import serial
 from . import bus
 from serial import SerialException
-from queue import Queue, Empty
+from collections import deque
 
 SERIAL_TIMER = 0.1
+REPLY_TIMEOUT = 1.0
+READ_BUFFER_SIZE = 4096
+MAX_CONNECT_DELAY = 2.0
 
 
 class PLA_INO_Sensor:
     """Custom class for the PLA_INO sensor"""
+    # The INO gcode commands are shared by all sensors and only registered
+    # by the first one; reset in load_config() on every config (re)load
+    _gcode_registered = False
+
     def __init__(self, config):
         """The sensor is initialized, this includes especially
         - the registration for specific events (and how to handle those)
@@ -30,12 +38,20 @@ class PLA_INO_Sensor:
         self.printer.add_object("pla_ino_sensor " + self.name, self)
         self.heater = None
         self.serial = None
-        self.read_timer = None
+        self.read_handle = None
         self.temp = 0.0
-        self.read_buffer = ""
-        self.read_queue = Queue()
+        # preallocated receive buffer, read_len bytes of it are valid
+        self.read_buffer = bytearray(READ_BUFFER_SIZE)
+        self.read_len = 0
+        self.read_queue = deque()
         self.write_timer = None
-        self.write_queue = Queue()
+        self.write_queue = deque()
+        # time of the outstanding "r" poll, None once the board answered
+        self.poll_time = None
+
+        # failed serial open attempts, retried with exponential backoff
+        self.connect_timer = None
+        self.failed_connection_attempts = 0
 
         # To avoid restart of ino sensor without being initialized again
         self.once_in_a_lifetime_connect = True
@@ -45,13 +61,12 @@ class PLA_INO_Sensor:
         self.printer.register_event_handler(
             "klippy:disconnect", self._handle_disconnect
         )
-        self.printer.register_event_handler("klippy:shutdown", self._handle_shutdown)
+        self.printer.register_event_handler(
+            "klippy:shutdown", self._handle_disconnect
+        )
 
         # add the gcode commands
-        logging.info(f"J: gcode ready handlers: {self.gcode.ready_gcode_handlers.keys()}")
-        if "INO_FREQUENCY" in self.gcode.ready_gcode_handlers.keys():
-            logging.info("J: INO Frequency already defined!")
-        else:
+        if not PLA_INO_Sensor._gcode_registered:
             self.gcode.register_command(
                 "INO_FREQUENCY", self.cmd_INO_FREQUENCY, desc=self.cmd_INO_FREQUENCY_help
             )
@@ -76,6 +91,7 @@ class PLA_INO_Sensor:
             self.gcode.register_command(
                 "INO_DEBUG_OUT", self.cmd_INO_DEBUG_OUT, desc=self.cmd_INO_DEBUG_OUT_help
             )
+            PLA_INO_Sensor._gcode_registered = True
             logging.info(f"J: All Gcode commands added.")
 
     def make_heater_known(self, heater, config):
@@ -99,6 +115,8 @@ class PLA_INO_Sensor:
         """
         self.baud = 115200
         self.serial_port = config.get("serial")
+        # log the raw serial traffic to and from the INO board
+        self.debug = config.getboolean("PLA_INO_debug", False)
         self.report_time = self.heater.pwm_delay
         self.pid_Kp = self.heater.pid_Kp
         self.pid_Ki = self.heater.pid_Ki
@@ -112,42 +130,52 @@ class PLA_INO_Sensor:
         )
 
     def _handle_connect(self):
-        if self.serial is None:
-            self._init_PLA_INO()
+        if self.serial is None and self.connect_timer is None:
+            self.connect_timer = self.reactor.register_timer(
+                self._connect_PLA_INO, self.reactor.NOW
+            )
 
     def _handle_disconnect(self):
         self.disconnect()
 
-    def _handle_shutdown(self):
-        logging.info("J: Ino heater shutting down")
-        self.disconnect()
-
     def disconnect(self):
         """Once disconnect is called, the sensor will start shutting down.
         This includes:
         - Setting the temperature of the INO heater to 0
         - closing of the serial connection to the INO board
-        - Unregisters the timers from this sensor
+        - Unregisters the timers and the serial read handler from this sensor
         """
-        try:
-            s = "s 0"
-            self.write_queue.put(s)
-            self.serial.close()
-            self.serial = None
-            logging.info("Serial port closed due to disconnect.")
-        except serial.SerialException:
-            logging.exception("J: Serial port already closed before disconnection.")
-        try:
-            self.reactor.unregister_timer(self.read_timer)
-            self.read_timer = None
-        except:
-            logging.info("J: Reactor read timer already unregistered before disconnection.")
+        logging.info("J: Ino heater shutting down")
+        if self.read_handle is not None:
+            try:
+                self.reactor.unregister_fd(self.read_handle)
+            finally:
+                self.read_handle = None
 
-        try:
-            self.reactor.unregister_timer(self.write_timer)
-            self.write_timer = None
-        except:
-            logging.info("J: Reactor write timer already unregistered before disconnection.")
+        if self.serial is not None:
+            try:
+                self.serial.write(b"s 0;\x00")
+            except serial.SerialException:
+                logging.exception("J: Unable to set the Ino heater to 0.")
+            try:
+                self.serial.close()
+                logging.info("Serial port closed due to disconnect.")
+            except serial.SerialException:
+                logging.exception("J: Unable to close the Ino serial port.")
+            finally:
+                self.serial = None
+
+        if self.write_timer is not None:
+            try:
+                self.reactor.unregister_timer(self.write_timer)
+            finally:
+                self.write_timer = None
+
+        if self.connect_timer is not None:
+            try:
+                self.reactor.unregister_timer(self.connect_timer)
+            finally:
+                self.connect_timer = None
 
         logging.info("J: Ino heater shut down complete.")
         self.once_in_a_lifetime_connect = False
@@ -171,18 +199,39 @@ class PLA_INO_Sensor:
     ### INO specifics
     def _sample_PLA_INO(self, eventtime):
         try:
-            if self.serial is None:
-                self._handle_connect()
-            else:
-                self.write_queue.put("r")
+            if self.serial is not None and (
+                self.poll_time is None
+                or eventtime - self.poll_time > REPLY_TIMEOUT
+            ):
+                self.write_queue.append(b"r")
+                self.poll_time = eventtime
         except serial.SerialException:
             logging.error("Unable to communicate with Ino. Sample")
             self.temp = 0.1
 
-        measured_time = self.reactor.monotonic()
-        self._callback(measured_time, self.temp)
+        self._callback(eventtime, self.temp)
         return eventtime + self.report_time
 
+    def _connect_PLA_INO(self, eventtime):
+        """Timer opening the serial connection to the ino board, retried
+        with exponential backoff until the connection succeeds
+
+        :param eventtime: current event time
+        :type eventtime: ?
+        :return: time of the next connection attempt
+        :rtype: float
+        """
+        self._init_PLA_INO()
+        if self.serial is not None or not self.once_in_a_lifetime_connect:
+            self.failed_connection_attempts = 0
+            return self.reactor.NEVER
+        delay = min(
+            SERIAL_TIMER * (1 << self.failed_connection_attempts),
+            MAX_CONNECT_DELAY,
+        )
+        if delay < MAX_CONNECT_DELAY:
+            self.failed_connection_attempts += 1
+        return eventtime + delay
 
     def _init_PLA_INO(self):
         """Initializes the INO by starting a serial connection to the ino board
@@ -190,25 +239,31 @@ class PLA_INO_Sensor:
         """
         if self.once_in_a_lifetime_connect:
             try:
-                self.serial = serial.Serial(self.serial_port)
+                self.serial = serial.Serial(self.serial_port, timeout=0)
                 logging.info("Connection to Ino successfull.")
             except serial.SerialException:
                 logging.error("Unable to connect to Ino. Init")
                 return
+            try:
+                self.serial.set_low_latency_mode(True)
+            except ValueError:
+                logging.info("J: Ino serial port does not support low latency mode.")
 
-            with self.write_queue.mutex:
-                self.write_queue.queue.clear()
-            with self.read_queue.mutex:
-                self.read_queue.queue.clear()
+            self.write_queue.clear()
+            self.read_queue.clear()
+            self.read_len = 0
+            self.poll_time = None
 
             logging.info("Ino queues cleared.")
 
-            self.read_timer = self.reactor.register_timer(self._run_Read, self.reactor.NOW)
+            self.read_handle = self.reactor.register_fd(
+                self.serial.fileno(), self._run_Read
+            )
             self.write_timer = self.reactor.register_timer(
                 self._run_Write, self.reactor.NOW
             )
 
-            logging.info("Ino read/write timers started.")
+            logging.info("Ino read handler and write timer started.")
             s = (
                 "kp "
                 + str(float(self.pid_Kp))
@@ -218,57 +273,66 @@ class PLA_INO_Sensor:
                 + str(float(self.pid_Kd))
                 + ";q"
             )
-            self.write_queue.put(s)
+            self.write_queue.append(s.encode())
         else:
             logging.info("J: Once in a lifetime connect already used up!")
 
     def _run_Read(self, eventtime):
-        """Readout of the incoming messages over the serial port
+        """Readout of the incoming messages over the serial port, called by
+        the reactor whenever the serial file descriptor becomes readable
 
         :param eventtime: current event time
         :type eventtime: ?
-        :return: tell reactor not to call this function any more (if not available)
-        :rtype: ?
         """
-        # Do non-blocking reads from serial and try to find lines
+        # Drain the serial port directly into the free end of the buffer
+        buf = self.read_buffer
+        try:
+            count = os.readv(
+                self.serial.fileno(), [memoryview(buf)[self.read_len :]]
+            )
+        except OSError:
+            logging.error("Unable to communicate with Ino. Red")
+            self.disconnect()
+            return
+        if not count:
+            # pyserial sets VMIN=0/VTIME=0, so an empty read never raises
+            # EAGAIN; a readable fd returning 0 bytes is how a hangup shows
+            logging.error("Unable to communicate with Ino. Port returned no data")
+            self.disconnect()
+            return
+        # Extract all complete frames by advancing head through the buffer
+        rq = self.read_queue
+        head = 0
+        tail = self.read_len + count
+        if self.debug:
+            logging.info("J: Ino rx: %r", bytes(buf[self.read_len : tail]))
         while True:
-            try:
-                raw_bytes = ""
-                if self.serial.in_waiting > 0:
-                    raw_bytes = self.serial.read()
-                    # logging.info(f"J: Ino raw_bytes after read. {raw_bytes}")
-            except SerialException:
-                logging.error("Unable to communicate with Ino. Red")
-                self.disconnect()
-                return self.reactor.NEVER
-            if len(raw_bytes):
-                text_buffer = self.read_buffer + str(raw_bytes.decode())
-                while True:
-                    i = text_buffer.find("\x00")
-                    if i >= 0:
-                        line = text_buffer[0 : i + 1]
-                        self.read_queue.put(line.strip())
-                        text_buffer = text_buffer[i + 1 :]
-                    else:
-                        break
-                self.read_buffer = text_buffer
-            else:
+            i = buf.find(b"\x00", head, tail)
+            if i < 0:
                 break
+            rq.append(buf[head:i].decode(errors="replace").strip())
+            head = i + 1
+        # Move the trailing partial frame (if any) to the start of the buffer
+        if head:
+            buf[: tail - head] = buf[head:tail]
+            tail -= head
+        if tail >= READ_BUFFER_SIZE:
+            # Discard the unterminated data so the buffer is left empty
+            self.read_len = 0
+            self.printer.invoke_shutdown("INO read buffer overflow")
+            return
+        self.read_len = tail
 
         # Process any decoded lines from the device
-        while not self.read_queue.empty():
-            try:
-                # logging.info("Ino read from queue")
-                text_line = self.read_queue.get_nowait()
-            except Empty:
-                pass
+        while rq:
+            zwischenspeicher_variable = rq.popleft()
+            self.poll_time = None
 
-            zwischenspeicher_variable = text_line.rstrip("\x00")
             if str.isdigit(
                 zwischenspeicher_variable.replace("-", "")
             ):  # check if can be converted to int (includes negative nr)
                 self.temp = int(zwischenspeicher_variable) / 100
-            elif str(zwischenspeicher_variable[:5]) == "ERROR":
+            elif zwischenspeicher_variable.startswith("ERROR"):
                 self.gcode.respond_info(
                     "INO ERROR:)\n" + str(zwischenspeicher_variable)
                 )  # output to mainsail console
@@ -277,7 +341,7 @@ class PLA_INO_Sensor:
                     + str(zwischenspeicher_variable)
                     + "\n--------------------ERROR: ------------------------\n"
                 )
-            elif str(zwischenspeicher_variable[:5]) == "tick:":
+            elif zwischenspeicher_variable.startswith("tick:"):
                 # for error output:
                 start = zwischenspeicher_variable.find("err:")
                 read_from_board = zwischenspeicher_variable[start + 4 :]
@@ -328,8 +392,6 @@ class PLA_INO_Sensor:
             # file.write( "\n" + str( datetime.datetime.now().time() ) + " " + str(self.temp)  ) #writes time and temp to file
             # file.close()
 
-        return eventtime + SERIAL_TIMER
-
     def _run_Write(self, eventtime):
         """Write the messages that are in the queue to the serial connection
 
@@ -338,23 +400,25 @@ class PLA_INO_Sensor:
         :return: tell reactor not to call this function any more (if not available)
         :rtype: ?
         """
-        # logging.info(f"J: Write queue: status (empty) = {self.write_queue.empty()}")
-        # logging.info("Ino run write.")
-        while not self.write_queue.empty():
-            try:
-                text_line = self.write_queue.get_nowait()
-            except Empty:
-                continue
-
+        # Coalesce all pending messages into a single serial write
+        wq = self.write_queue
+        msgs = []
+        while wq:
+            text_line = wq.popleft()
             if text_line:
-                try:
-                    # logging.info("Ino run write text_line " + text_line)
-                    self.serial.write((text_line + ";\x00").encode())
-                    # logging.info("Ino did ran write text_line " + text_line)
-                except SerialException:
-                    logging.error("Unable to communicate with the Ino. Write")
-                    self.signal_disconnect = True
-                    return self.reactor.NEVER
+                if isinstance(text_line, str):
+                    text_line = text_line.encode()
+                msgs.append(text_line + b";\x00")
+        if msgs:
+            data = b"".join(msgs)
+            if self.debug:
+                logging.info("J: Ino tx: %r", data)
+            try:
+                self.serial.write(data)
+            except SerialException:
+                logging.error("Unable to communicate with the Ino. Write")
+                self.disconnect()
+                return self.reactor.NEVER
         return eventtime + SERIAL_TIMER
 
 
@@ -390,10 +454,8 @@ class PLA_INO_Sensor:
         :raises gcmd.error: raises error if command can not be executed on the configured heater
         """
         if heater.__class__.__name__ == "PLA_INO_Heater":
-            logging.info("J: sending command to PLA_INO_Heater")
-            queue = heater.sensor.write_queue
-            logging.info(f"J: queue: {queue}, message: {message}")
-            queue.put(message)
+            logging.debug("J: sending command to PLA_INO_Heater: %s", message)
+            heater.sensor.write_queue.append(message.encode())
         else:
             raise gcmd.error("Command not defined for this heater.")
 
@@ -505,6 +567,8 @@ class PLA_INO_Sensor:
 
 
 def load_config(config):
+    # A (re)loaded config gets a fresh gcode object, register commands again
+    PLA_INO_Sensor._gcode_registered = False
     # Register sensor
     pheaters = config.get_printer().load_object(config, "heaters")
     logging.info(f"J: heater in ino sensor: {pheaters.heaters}")